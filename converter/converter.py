@@ -1,11 +1,24 @@
 import os
-import time
-import pandas as pd
+import re
+import asyncio
+import functools
+import hmac
+import json
+import multiprocessing
 import s3fs
+from aiohttp import web
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from datetime import datetime
+from urllib.parse import unquote_plus, urlparse
+import requests
+import trino.exceptions
 from trino.dbapi import connect
 import pyarrow as pa
-import pyarrow.parquet as pq
+import pyarrow.compute as pc
+import pyarrow.csv as pacsv
+import pyarrow.dataset as ds
+import pyarrow.fs as pafs
 
 # =========================
 # CONFIG
@@ -27,49 +40,128 @@ TABLE_NAME = "shipments"
 RAW_PATH = f"{BUCKET}/raw/"
 BASE_PARQUET_PATH = f"{BUCKET}/parquet/{TABLE_NAME}/"
 
+# MinIO posts s3:ObjectCreated:* events here; listing is only a backstop
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8000"))
+# Must match MINIO_NOTIFY_WEBHOOK_AUTH_TOKEN_CONVERTER; empty disables the check
+WEBHOOK_AUTH_TOKEN = os.getenv("WEBHOOK_AUTH_TOKEN", "")
+POLL_MIN_INTERVAL = float(os.getenv("POLL_MIN_INTERVAL", "1"))
+POLL_MAX_INTERVAL = float(os.getenv("POLL_MAX_INTERVAL", "60"))
+
+# Local record of processed CSVs; .done flags on S3 stay for other consumers
+STATE_FILE = os.getenv("STATE_FILE", "/var/state/done.json")
+
+# Files converted in parallel, one worker process each
+CONVERT_WORKERS = int(os.getenv("CONVERT_WORKERS", str(os.cpu_count() or 1)))
+# Attempts before a failing file is flagged .failed and no longer retried
+CONVERT_MAX_ATTEMPTS = int(os.getenv("CONVERT_MAX_ATTEMPTS", "3"))
+
 # -------------------------
-# S3FS WITH CACHE DISABLED
+# ASYNC S3FS (POLLER) WITH SHORT-LIVED LISTINGS CACHE
+# -------------------------
+def make_async_s3fs():
+    # Must be created inside the running event loop
+    return s3fs.S3FileSystem(
+        key=ACCESS_KEY,
+        secret=SECRET_KEY,
+        client_kwargs={"endpoint_url": MINIO_ENDPOINT},
+        asynchronous=True,
+        skip_instance_cache=True,
+        use_listings_cache=True,
+        listings_expiry_time=5,
+        cache_regions=False
+    )
+
 # -------------------------
-fs = s3fs.S3FileSystem(
-    key=ACCESS_KEY,
-    secret=SECRET_KEY,
-    client_kwargs={"endpoint_url": MINIO_ENDPOINT},
-    skip_instance_cache=True,
-    use_listings_cache=False,
-    cache_regions=False
+# ARROW S3 FILESYSTEM (CSV READS, PARQUET WRITES)
+# -------------------------
+_endpoint = urlparse(MINIO_ENDPOINT)
+arrow_fs = pafs.S3FileSystem(
+    endpoint_override=_endpoint.netloc,
+    scheme=_endpoint.scheme or "http",
+    access_key=ACCESS_KEY,
+    secret_key=SECRET_KEY,
+    allow_bucket_creation=False,
+    allow_bucket_deletion=False,
+)
+
+# Parquet output streams upload their parts on Arrow's I/O thread pool.
+# UPLOAD_THREADS is per conversion worker and never below Arrow's default
+UPLOAD_THREADS = int(os.getenv("UPLOAD_THREADS", "16"))
+
+CSV_BLOCK_SIZE = 8 << 20  # 8 MiB per parsed block
+ROW_GROUP_SIZE = int(os.getenv("PARQUET_ROW_GROUP", "8192"))  # rows per Parquet row group
+COMPRESSION_LEVEL = int(os.getenv("PARQUET_ZSTD_LEVEL", "3"))
+MAX_ROWS_PER_FILE = int(os.getenv("PARQUET_MAX_ROWS_PER_FILE", str(1 << 20)))
+
+PARTITIONING = ds.partitioning(
+    pa.schema([("date_of_shipment", pa.string())]), flavor="hive"
 )
 
 # =========================
 # TRINO EXEC
 # =========================
 
-def trino_exec(sql):
-    conn = None
+@functools.lru_cache(maxsize=1)
+def _get_conn():
+    # One connection (HTTP session) reused for every statement
+    return connect(
+        host=TRINO_HOST,
+        port=TRINO_PORT,
+        user=TRINO_USER,
+        catalog=TRINO_CATALOG,
+        schema=TRINO_SCHEMA,
+    )
+
+
+def _reset_conn():
+    if not _get_conn.cache_info().currsize:
+        return
     try:
-        conn = connect(
-            host=TRINO_HOST,
-            port=TRINO_PORT,
-            user=TRINO_USER,
-            catalog=TRINO_CATALOG,
-            schema=TRINO_SCHEMA,
-        )
-        cur = conn.cursor()
-        cur.execute(sql)
-        cur.fetchall()
-        cur.close()
-    except Exception as e:
-        print(f"[TRINO ERROR] Query failed:\n{sql}\nError: {e}")
-        raise
+        _get_conn().close()
     finally:
-        if conn:
-            conn.close()
+        _get_conn.cache_clear()
+
+
+# Connection/transport failures; SQL errors are deterministic and not retried
+TRANSIENT_TRINO_ERRORS = (
+    requests.exceptions.RequestException,
+    trino.exceptions.HttpError,
+    trino.exceptions.OperationalError,
+)
+
+
+def trino_exec(sql):
+    for attempt in (1, 2):
+        try:
+            cur = _get_conn().cursor()
+            cur.execute(sql)
+            # execute() returns at the first row; fetching drives the query to completion
+            cur.fetchall()
+            cur.close()
+            return
+        except TRANSIENT_TRINO_ERRORS as e:
+            _reset_conn()
+            if attempt == 2:
+                print(f"[TRINO ERROR] Query failed:\n{sql}\nError: {e}")
+                raise
+            print(f"[WARN] Trino query failed, retrying on a new connection: {e}")
+        except Exception as e:
+            print(f"[TRINO ERROR] Query failed:\n{sql}\nError: {e}")
+            raise
 
 
 # =========================
 # CREATE TABLE IF NEEDED
 # =========================
 
+_TABLE_READY = False
+
+
 def ensure_table_exists():
+    global _TABLE_READY
+    if _TABLE_READY:
+        return
+
     sql = f"""
     CREATE TABLE IF NOT EXISTS {TRINO_CATALOG}.{TRINO_SCHEMA}.{TABLE_NAME} (
         shipment_number VARCHAR,
@@ -96,6 +188,7 @@ def ensure_table_exists():
     )
     """
     trino_exec(sql)
+    _TABLE_READY = True
     print(f"[INFO] Table {TABLE_NAME} ensured in Trino")
 
 
@@ -110,149 +203,468 @@ def sync_partitions(mode="ADD"):
     )
     print(f"[INFO] Syncing partitions (mode={mode})...")
     try:
+        # No-op once the table exists; retries here if it failed at startup
+        ensure_table_exists()
         trino_exec(sql)
         print("[INFO] Partitions synchronized")
+        return True
     except Exception as e:
         # If sync fails, log warning but don't fail - partitions might already exist
         print(f"[WARN] Partition sync completed with warnings: {e}")
         # Don't re-raise - allow conversion to continue
+        return False
 
 
 # =========================
 # CONVERSION
 # =========================
 
-def convert_csv_to_parquet(filename):
-    if not filename.endswith(".csv"):
-        return
+PARQUET_SCHEMA = pa.schema([
+    ("shipment_number", pa.string()),
+    ("hour_of_shipment", pa.string()),
+    ("sender_city", pa.string()),
+    ("sender_country", pa.dictionary(pa.int32(), pa.string())),
+    ("sender_terminal", pa.dictionary(pa.int32(), pa.string())),
+    ("receiver_city", pa.string()),
+    ("receiver_country", pa.dictionary(pa.int32(), pa.string())),
+    ("receiver_terminal", pa.dictionary(pa.int32(), pa.string())),
+    ("package_type", pa.dictionary(pa.int32(), pa.string())),
+    ("weight", pa.float64()),
+    ("size", pa.dictionary(pa.int32(), pa.string())),
+    ("sender_latitude", pa.float64()),
+    ("sender_longitude", pa.float64()),
+    ("receiver_latitude", pa.float64()),
+    ("receiver_longitude", pa.float64()),
+    ("date_of_shipment", pa.string())
+])
+
+# CSV header name -> Parquet column name
+CSV_RENAMES = {
+    "latitude": "sender_latitude",
+    "longitude": "sender_longitude",
+}
+
+NUMERIC_COLS = frozenset(
+    field.name for field in PARQUET_SCHEMA if pa.types.is_floating(field.type)
+)
 
-    src = f"s3://{RAW_PATH}{filename}"
+# Types are applied by the CSV parser itself, keyed by the CSV header names.
+# Numeric columns are read as text and coerced per batch, so one bad cell
+# becomes null instead of failing the whole file
+CSV_COLUMN_TYPES = {
+    field.name: pa.string() if field.name in NUMERIC_COLS else field.type
+    for field in PARQUET_SCHEMA
+}
+for _csv_name, _name in CSV_RENAMES.items():
+    CSV_COLUMN_TYPES[_csv_name] = CSV_COLUMN_TYPES.pop(_name)
 
-    try:
-        print(f"[INFO] Reading CSV: {src}")
-
-        df = pd.read_csv(
-            src,
-            storage_options={
-                "key": ACCESS_KEY,
-                "secret": SECRET_KEY,
-                "client_kwargs": {"endpoint_url": MINIO_ENDPOINT},
-            },
-        )
+NUMBER_PATTERN = r"^[-+]?(\d+\.?\d*|\.\d+)([eE][-+]?\d+)?$"
 
-        expected_cols = [
-            "shipment_number", "date_of_shipment", "hour_of_shipment",
-            "sender_city", "latitude", "longitude",
-            "sender_country", "sender_terminal",
-            "receiver_country", "package_type", "weight", "size",
-            "receiver_city", "receiver_terminal",
-            "receiver_latitude", "receiver_longitude"
-        ]
+EXPECTED_COLS = frozenset(CSV_COLUMN_TYPES)
 
-        if not all(col in df.columns for col in expected_cols):
-            print(f"[DEBUG] Columns in {filename}: {list(df.columns)}")
-            print(f"[DEBUG] Missing columns: {[c for c in expected_cols if c not in df.columns]}")
-            print(f"[WARN] {filename} has invalid columns. Skipping.")
-            print("Columns:", df.columns.tolist())
-            return
 
-        # Rename lat/lon
-        df.rename(columns={
-            "latitude": "sender_latitude",
-            "longitude": "sender_longitude",
-        }, inplace=True)
+def init_worker():
+    # Runs once in every conversion process, not at import time
+    pa.set_io_thread_count(max(pa.io_thread_count(), UPLOAD_THREADS))
+    # CSV parsing and write_dataset use Arrow's CPU pool; share the cores
+    # between workers instead of running cpu_count threads in each of them
+    pa.set_cpu_count(max(1, (os.cpu_count() or 1) // CONVERT_WORKERS))
 
-        numeric_cols = ["weight", "sender_latitude", "sender_longitude",
-                        "receiver_latitude", "receiver_longitude"]
 
-        for col in numeric_cols:
-            df[col] = pd.to_numeric(df[col], errors="coerce")
+def coerce_numeric(column):
+    # Same as pd.to_numeric(errors="coerce"): anything not a number becomes null
+    column = pc.utf8_trim_whitespace(column)
+    is_number = pc.match_substring_regex(column, NUMBER_PATTERN)
+    return pc.cast(
+        pc.if_else(is_number, column, pa.scalar(None, pa.string())), pa.float64()
+    )
 
-        string_cols = [
-            "shipment_number", "hour_of_shipment", "sender_city",
-            "sender_country", "sender_terminal", "receiver_city",
-            "receiver_country", "receiver_terminal", "package_type",
-            "size", "date_of_shipment"
-        ]
-        df[string_cols] = df[string_cols].fillna("").astype(str)
-
-        schema = pa.schema([
-            ("shipment_number", pa.string()),
-            ("hour_of_shipment", pa.string()),
-            ("sender_city", pa.string()),
-            ("sender_country", pa.string()),
-            ("sender_terminal", pa.string()),
-            ("receiver_city", pa.string()),
-            ("receiver_country", pa.string()),
-            ("receiver_terminal", pa.string()),
-            ("package_type", pa.string()),
-            ("weight", pa.float64()),
-            ("size", pa.string()),
-            ("sender_latitude", pa.float64()),
-            ("sender_longitude", pa.float64()),
-            ("receiver_latitude", pa.float64()),
-            ("receiver_longitude", pa.float64()),
-            ("date_of_shipment", pa.string())
-        ])
-
-        # Write partitions
-        for date, group in df.groupby("date_of_shipment"):
-            dst_file = (
-                f"s3://{BASE_PARQUET_PATH}"
-                f"date_of_shipment={date}/"
-                f"{filename.replace('.csv', f'_{date}.parquet')}"
-            )
-
-            print(f"[INFO] Saving Parquet for date {date}: {dst_file}")
-
-            table = pa.Table.from_pandas(group, schema=schema, preserve_index=False)
-            with fs.open(dst_file, "wb") as f:
-                pq.write_table(table, f)
-
-        print(f"[OK] Converted {filename} -> {len(df['date_of_shipment'].unique())} partitions")
 
-        ensure_table_exists()
-        try:
-            sync_partitions("ADD")
-        except Exception as sync_error:
-            print(f"[WARN] Partition sync failed (non-critical): {sync_error}")
-            # Continue even if sync fails - partitions might already exist
+def remove_partial_output(stem, dates):
+    # Drop the files this CSV already wrote, so no partition keeps a
+    # truncated Parquet file (no footer) that would break Trino scans
+    written = re.compile(rf"{re.escape(stem)}-\d+\.parquet")
+    for date in dates:
+        selector = pafs.FileSelector(
+            f"{BASE_PARQUET_PATH}date_of_shipment={date}", allow_not_found=True
+        )
+        for info in arrow_fs.get_file_info(selector):
+            if written.fullmatch(info.base_name):
+                arrow_fs.delete_file(info.path)
+                print(f"[INFO] Removed partial output: s3://{info.path}")
+
+
+def read_csv_header(src):
+    with arrow_fs.open_input_stream(src) as stream:
+        reader = pacsv.open_csv(
+            stream,
+            read_options=pacsv.ReadOptions(block_size=CSV_BLOCK_SIZE),
+            convert_options=pacsv.ConvertOptions(column_types=CSV_COLUMN_TYPES),
+        )
+        return reader.schema.names
+
+
+def convert_csv_to_parquet(filename):
+    # Returns the partition dates written (empty for skipped files);
+    # raises on failure so the file is not marked done
+    if not filename.endswith(".csv"):
+        return set()
+
+    src = f"{RAW_PATH}{filename}"
+
+    try:
+        print(f"[INFO] Reading CSV: s3://{src}")
+
+        with arrow_fs.open_input_stream(src) as stream:
+            try:
+                # Extra columns are dropped instead of type-inferred, so they
+                # cannot fail the conversion in a later block
+                reader = pacsv.open_csv(
+                    stream,
+                    read_options=pacsv.ReadOptions(
+                        block_size=CSV_BLOCK_SIZE, use_threads=True
+                    ),
+                    convert_options=pacsv.ConvertOptions(
+                        column_types=CSV_COLUMN_TYPES,
+                        include_columns=list(CSV_COLUMN_TYPES),
+                    ),
+                )
+            except pa.ArrowKeyError:
+                # Only the first block has been read so far, so a malformed
+                # file is rejected without downloading the rest of it
+                columns = read_csv_header(src)
+                print(f"[DEBUG] Columns in {filename}: {columns}")
+                print(f"[DEBUG] Missing columns: {sorted(EXPECTED_COLS - set(columns))}")
+                print(f"[WARN] {filename} has invalid columns. Skipping.")
+                return set()
+
+            dates = set()
+
+            def aligned_batches():
+                # Rename lat/lon, put columns in schema order and coerce the
+                # numeric columns; the rest already have their final types
+                for batch in reader:
+                    batch = batch.rename_columns([CSV_RENAMES.get(n, n) for n in batch.schema.names])
+                    batch = pa.RecordBatch.from_arrays(
+                        [
+                            coerce_numeric(batch[name]) if name in NUMERIC_COLS else batch[name]
+                            for name in PARQUET_SCHEMA.names
+                        ],
+                        schema=PARQUET_SCHEMA,
+                    )
+                    dates.update(pc.unique(batch["date_of_shipment"]).to_pylist())
+                    yield batch
+
+            # Stream batches straight into the partitioned writer
+            # (date_of_shipment=YYYY-MM-DD/<csv name>-<i>.parquet)
+            print(f"[INFO] Saving Parquet: s3://{BASE_PARQUET_PATH}")
+
+            stem = filename[:-len(".csv")]
+            try:
+                ds.write_dataset(
+                    aligned_batches(),
+                    schema=PARQUET_SCHEMA,
+                    base_dir=BASE_PARQUET_PATH.rstrip("/"),
+                    basename_template=f"{stem}-{{i}}.parquet",
+                    partitioning=PARTITIONING,
+                    filesystem=arrow_fs,
+                    format="parquet",
+                    file_options=ds.ParquetFileFormat().make_write_options(
+                        compression="zstd",
+                        compression_level=COMPRESSION_LEVEL,
+                        use_dictionary=True,
+                        data_page_size=1 << 20,
+                        write_statistics=True,
+                    ),
+                    max_rows_per_file=MAX_ROWS_PER_FILE,
+                    min_rows_per_group=ROW_GROUP_SIZE,
+                    max_rows_per_group=ROW_GROUP_SIZE,
+                    existing_data_behavior="overwrite_or_ignore",
+                    create_dir=False,
+                    use_threads=True,
+                )
+            except Exception:
+                # Files are opened before the whole CSV is parsed, so a
+                # failure in a later block must not leave them behind
+                remove_partial_output(stem, dates)
+                raise
+
+        print(f"[OK] Converted {filename} -> {len(dates)} partitions: {sorted(dates)}")
+
+        return dates
 
     except Exception as e:
         print(f"[ERROR] Conversion failed for {filename}: {e}")
+        raise
+
+
+# =========================
+# PROCESSED-FILES MANIFEST
+# =========================
+
+def load_manifest():
+    try:
+        with open(STATE_FILE, "r") as f:
+            return set(json.load(f))
+    except FileNotFoundError:
+        return set()
+    except Exception as e:
+        print(f"[WARN] Could not read manifest {STATE_FILE}, starting empty: {e}")
+        return set()
+
+
+def save_manifest(names):
+    # Write to a temp file and rename so a crash never leaves a torn manifest
+    os.makedirs(os.path.dirname(STATE_FILE) or ".", exist_ok=True)
+    tmp_path = f"{STATE_FILE}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(sorted(names), f)
+    os.replace(tmp_path, STATE_FILE)
 
 
 # =========================
-# POLLER WITH CACHE INVALIDATION
+# POLLER
 # =========================
 
 class MinioPoller:
-    def poll(self):
-        while True:
-            try:
-                # Force fresh listing
-                fs.invalidate_cache(RAW_PATH)
+    def __init__(self):
+        self.queue = asyncio.Queue()
+        self.queued = set()
+        self.synced_dates = set()
+        self.unsynced_dates = set()
+        self.sync_task = None
+        self.tasks = set()
+        self.done = load_manifest()
+        self.manifest_dirty = False
+        self.manifest_task = None
+        self.failed = {}  # file name -> failed attempts so far
+        self.fs = None
+        self.pool = self.new_pool()
+
+    def new_pool(self, max_workers=CONVERT_WORKERS):
+        # spawn, not fork: the parent runs an event loop and Arrow thread pools
+        return ProcessPoolExecutor(
+            max_workers=max_workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=init_worker,
+        )
 
-                files = [
-                    f for f in fs.ls(RAW_PATH)
-                    if f.endswith(".csv") and not fs.exists(f + ".done")
-                ]
+    async def convert(self, fname):
+        # A worker that dies (e.g. OOM-killed) breaks the whole pool and every
+        # file in flight with it. Replace the shared pool once, then retry the
+        # file on its own so a file that kills its worker cannot take the
+        # others down again; BrokenProcessPool from that retry is the file's
+        loop = asyncio.get_running_loop()
+        pool = self.pool
+        try:
+            return await loop.run_in_executor(pool, convert_csv_to_parquet, fname)
+        except BrokenProcessPool:
+            if self.pool is pool:
+                print("[WARN] Conversion pool broken, starting a new one")
+                pool.shutdown(wait=False, cancel_futures=True)
+                self.pool = self.new_pool()
+
+        solo = self.new_pool(max_workers=1)
+        try:
+            return await loop.run_in_executor(solo, convert_csv_to_parquet, fname)
+        finally:
+            solo.shutdown(wait=False)
+
+    def enqueue(self, fname):
+        if fname in self.queued:
+            return False
+        self.queued.add(fname)
+        self.queue.put_nowait(fname)
+        return True
+
+    async def list_pending(self):
+        # One LIST per cycle; .done flags are matched against it
+        # instead of a HEAD request per file
+        done = set(self.done)
+        entries = set(await self.fs._ls(RAW_PATH, detail=False))
+
+        # Deleting a flag forces a reprocess, so drop manifest entries whose
+        # flag is gone (names recorded before the LIST already had theirs)
+        stale = {
+            name for name in done
+            if f"{RAW_PATH}{name}" in entries
+            and f"{RAW_PATH}{name}.done" not in entries
+            and f"{RAW_PATH}{name}.failed" not in entries
+        }
+        if stale:
+            print(f"[INFO] Flags removed, reprocessing: {sorted(stale)}")
+            self.done -= stale
+            self.start_manifest_save()
+
+        return [
+            f.split("/")[-1] for f in sorted(entries)
+            if f.endswith(".csv")
+            and f.split("/")[-1] not in self.done
+            and (f + ".done") not in entries
+            and (f + ".failed") not in entries
+        ]
 
-                for f in files:
-                    fname = f.split("/")[-1]
-                    convert_csv_to_parquet(fname)
+    async def mark_done(self, fname):
+        # Create .done flag (zero-byte PUT)
+        done_path = f"s3://{RAW_PATH}{fname}.done"
+        await self.fs._touch(done_path)
+        self.done.add(fname)
 
-                    # Create .done flag
-                    done_path = f"s3://{RAW_PATH}{fname}.done"
-                    with fs.open(done_path, "w") as df:
-                        df.write("processed")
+        print(f"[INFO] Flag created: {done_path}")
 
-                    print(f"[INFO] Flag created: {done_path}")
+    async def give_up(self, fname, error):
+        # Flag the file so neither the poll nor a restart picks it up again
+        failed_path = f"s3://{RAW_PATH}{fname}.failed"
+        print(f"[ERROR] Giving up on {fname}: {error}")
+        try:
+            await self.fs._touch(failed_path)
+            self.done.add(fname)
+            print(f"[INFO] Flag created: {failed_path}")
+        except Exception as e:
+            print(f"[WARN] Could not flag {fname} as failed: {e}")
+
+    async def process(self, fname):
+        # Conversion runs in a worker process; flags and Trino stay in the parent
+        try:
+            dates = await self.convert(fname)
+            await self.mark_done(fname)
+            self.failed.pop(fname, None)
+            return dates
+        except Exception as e:
+            # Bad CSV content (ArrowInvalid) or a file that kills its worker
+            # on its own will fail the same way again; anything else is
+            # retried by the backstop poll up to CONVERT_MAX_ATTEMPTS
+            attempts = self.failed.pop(fname, 0) + 1
+            if isinstance(e, (pa.ArrowInvalid, BrokenProcessPool)) or attempts >= CONVERT_MAX_ATTEMPTS:
+                await self.give_up(fname, e)
+            else:
+                self.failed[fname] = attempts
+                print(f"[WARN] Processing error for {fname} (attempt {attempts}/{CONVERT_MAX_ATTEMPTS}), will retry: {e}")
+            return set()
+        finally:
+            self.queued.discard(fname)
+
+    async def handle_event(self, request):
+        if WEBHOOK_AUTH_TOKEN:
+            # MinIO sends the token as "Bearer <token>" unless it has a space
+            auth = request.headers.get("Authorization", "")
+            if not any(
+                hmac.compare_digest(auth.encode(), expected.encode())
+                for expected in (f"Bearer {WEBHOOK_AUTH_TOKEN}", WEBHOOK_AUTH_TOKEN)
+            ):
+                return web.Response(status=401)
 
+        try:
+            payload = await request.json()
+        except Exception:
+            return web.Response(status=400)
+        if not isinstance(payload, dict) or not isinstance(payload.get("Records", []), list):
+            return web.Response(status=400)
+
+        for record in payload.get("Records", []):
+            s3 = record.get("s3") if isinstance(record, dict) else None
+            if not isinstance(s3, dict):
+                continue
+            bucket, obj = s3.get("bucket"), s3.get("object")
+            if not isinstance(bucket, dict) or not isinstance(obj, dict):
+                continue
+            if not isinstance(bucket.get("name"), str) or not isinstance(obj.get("key"), str):
+                continue
+            path = f"{bucket['name']}/{unquote_plus(obj['key'])}"
+            fname = path[len(RAW_PATH):]
+            if path.startswith(RAW_PATH) and fname.endswith(".csv") and "/" not in fname:
+                if self.enqueue(fname):
+                    print(f"[INFO] Event received: s3://{path}")
+
+        return web.Response()
+
+    async def poll(self):
+        # Backstop for missed events: back off while idle, reset on work
+        delay = POLL_MIN_INTERVAL
+        while True:
+            found = False
+            try:
+                for fname in await self.list_pending():
+                    # Files that failed before are retried at the idle pace
+                    # instead of resetting the backoff every cycle
+                    if self.enqueue(fname) and fname not in self.failed:
+                        found = True
             except Exception as e:
                 print(f"[WARN] Poll error: {e}")
 
-            time.sleep(10)
+            # Retry a failed sync even when no new file arrives
+            self.start_sync()
+
+            delay = POLL_MIN_INTERVAL if found else min(POLL_MAX_INTERVAL, delay * 2)
+            await asyncio.sleep(delay)
+
+    async def consume(self):
+        # One task per file, at most CONVERT_WORKERS at a time, so a large
+        # CSV never holds back files queued after it
+        slots = asyncio.Semaphore(CONVERT_WORKERS)
+        while True:
+            fname = await self.queue.get()
+            await slots.acquire()
+            task = asyncio.create_task(self.handle_file(fname))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+            task.add_done_callback(lambda _: slots.release())
+
+    async def handle_file(self, fname):
+        dates = await self.process(fname)
+        self.start_manifest_save()
+
+        # Files landing in already registered partitions need no metadata
+        # change; new dates are synced by a single debounced task
+        self.unsynced_dates |= dates - self.synced_dates
+        self.start_sync()
+
+    def start_sync(self):
+        if self.unsynced_dates and (self.sync_task is None or self.sync_task.done()):
+            self.sync_task = asyncio.create_task(self.sync())
+
+    async def sync(self):
+        # Dates from files finishing while a sync runs go into the next round
+        loop = asyncio.get_running_loop()
+        while self.unsynced_dates:
+            dates, self.unsynced_dates = self.unsynced_dates, set()
+            if await loop.run_in_executor(None, sync_partitions, "ADD"):
+                self.synced_dates |= dates
+            else:
+                # Retried when the next file completes or on the next poll
+                self.unsynced_dates |= dates
+                return
+
+    def start_manifest_save(self):
+        self.manifest_dirty = True
+        if self.manifest_task is None or self.manifest_task.done():
+            self.manifest_task = asyncio.create_task(self.write_manifest())
+
+    async def write_manifest(self):
+        # One write covers every file finished while the previous one ran
+        loop = asyncio.get_running_loop()
+        while self.manifest_dirty:
+            self.manifest_dirty = False
+            try:
+                await loop.run_in_executor(None, save_manifest, sorted(self.done))
+            except Exception as e:
+                # Rewritten in full when the next file completes
+                self.manifest_dirty = True
+                print(f"[WARN] Could not write manifest {STATE_FILE}: {e}")
+                return
+
+    async def run(self):
+        self.fs = make_async_s3fs()
+        await self.fs.set_session()
+
+        app = web.Application()
+        app.router.add_post("/events", self.handle_event)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite(runner, "0.0.0.0", WEBHOOK_PORT).start()
+        print(f"[INFO] Listening for bucket events on :{WEBHOOK_PORT}/events")
+
+        await asyncio.gather(self.poll(), self.consume())
 
 
 # =========================
@@ -261,6 +673,9 @@ class MinioPoller:
 
 if __name__ == "__main__":
     print(f"[INFO] Poller started, watching: s3://{RAW_PATH}")
-    ensure_table_exists()
-    MinioPoller().poll()
+    try:
+        ensure_table_exists()
+    except Exception as e:
+        print(f"[WARN] Table not ensured at startup, retrying on next sync: {e}")
+    asyncio.run(MinioPoller().run())
     